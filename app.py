@@ -1,30 +1,122 @@
 import os
+import re
 import json
+import time
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI
+from functools import lru_cache
+from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from huggingface_hub import InferenceClient
+import httpx
+import torch
+import faiss
+import numpy as np
+from sentence_transformers import SentenceTransformer
 
 # ==============================
 # CONFIG
 # ==============================
 HF_TOKEN = os.getenv("HF_TOKEN") or "your_huggingface_token_here"
-MODEL_NAME = "mistralai/Mistral-7B-Instruct-v0.2"
+MODEL_NAME = os.getenv("MODEL_NAME", "mistralai/Mistral-7B-Instruct-v0.2")
+HF_URL = os.getenv(
+    "HF_URL", "https://router.huggingface.co/featherless-ai/v1/chat/completions"
+)  # ✅ must use new provider
+HEADERS = {"Authorization": f"Bearer {HF_TOKEN}"}
 
-# Initialize Hugging Face client
-client = InferenceClient(
-    model=MODEL_NAME,
-    token=HF_TOKEN,
-    provider="featherless-ai",  # ✅ must use new provider
+_SYS_MS = (
+    "Anda ialah pembantu Islam yang memahami Bahasa Melayu. "
+    "Bantu pengguna memahami mimpi, gangguan spiritual, ruqyah, dan penyembuhan Islam "
+    "berdasarkan Al-Quran dan Sunnah."
 )
+_SYS_EN = (
+    "You are an Islamic assistant that interprets dreams and spiritual sickness "
+    "based on Qur'an and Sunnah. Reply politely and concisely."
+)
+_PARAMS = {"max_tokens": 200, "temperature": 0.7}
+
+# Match to the HF API key's concurrency allowance; overflow gets a fast 429
+HF_MAX_CONCURRENCY = int(os.getenv("HF_MAX_CONCURRENCY", "8"))
+MAX_PENDING = 4 * HF_MAX_CONCURRENCY
+
+HF_SEM: asyncio.Semaphore = None
+
+LOG_FILE = "chat_logs.jsonl"
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOGS_LIMIT = 500  # max entries one /logs call returns
 
-LOG_FILE = "chat_logs.json"
+BASE = os.path.dirname(__file__)
+INDEX_PATH = os.path.join(BASE, "data", "knowledge_index.faiss")
+MAPPING_PATH = os.path.join(BASE, "data", "knowledge_mapping.json")
+TOP_K = int(os.getenv("TOP_K", "3"))
+# "onnx" (pip install sentence-transformers[onnx]) runs the int8-friendly
+# onnxruntime export, typically 2-4x faster than torch on CPU-only hosts
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+
+EMBEDDER = None
+
+FAISS_INDEX = None
+MAPPING = []
+MAPPING_CONTENTS = np.empty(0, dtype=object)
 
 # ==============================
 # APP SETUP
 # ==============================
-app = FastAPI(title="🕌 Islamic Spiritual Sickness Chatbot (2025-HF)")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One-time setup lives here rather than at import, so workers boot fast
+    # and can answer health checks before the heavy pieces are ready.
+    global _batch_queue, FAISS_INDEX, MAPPING, MAPPING_CONTENTS, HF_SEM, EMBEDDER, _kb_version
+    # One pooled async client shared by all requests (keep-alive, no per-call TLS handshake)
+    app.state.http = httpx.AsyncClient(
+        timeout=60,
+        http2=True,
+        headers=HEADERS,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+    _batch_queue = asyncio.Queue()
+    HF_SEM = asyncio.Semaphore(HF_MAX_CONCURRENCY)
+    app.state.batcher = asyncio.create_task(_batch_worker())
+    torch.set_num_threads(os.cpu_count() or 1)
+    EMBEDDER = SentenceTransformer(
+        "sentence-transformers/all-MiniLM-L6-v2", backend=EMBED_BACKEND
+    )
+    # Load the prebuilt KB index (see rag_indexer.py) for top-k retrieval
+    if os.path.exists(INDEX_PATH) and os.path.exists(MAPPING_PATH):
+        # mmap keeps the vectors on shared pages across uvicorn workers
+        FAISS_INDEX = faiss.read_index(
+            INDEX_PATH, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        )
+        with open(MAPPING_PATH, "rb") as f:
+            raw = f.read()
+        MAPPING = json.loads(raw)
+        MAPPING_CONTENTS = np.array([m["content"] for m in MAPPING], dtype=object)
+        _kb_version = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    # Throwaway call so the HF model is warm before the first real user
+    try:
+        await app.state.http.post(
+            HF_URL,
+            json={
+                "model": MODEL_NAME,
+                "messages": [{"role": "user", "content": "ping"}],
+                "max_tokens": 1,
+            },
+        )
+    except Exception:
+        pass
+    yield
+    app.state.batcher.cancel()
+    await app.state.http.aclose()
+
+app = FastAPI(
+    title="🕌 Islamic Spiritual Sickness Chatbot (2025-HF)",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -43,11 +135,16 @@ class ChatRequest(BaseModel):
 # ==============================
 # HELPERS
 # ==============================
+# Substring matching on purpose: Malay affixes keywords heavily
+# ("bermimpi", "berdoa"), so word-boundary or exact-token matching
+# misclassifies common phrasings. One precompiled alternation keeps it
+# a single scan of the lowered text.
+_MS_RE = re.compile(
+    "mimpi|ruqyah|jin|sihir|doa|solat|sakit|gangguan|syaitan|hati|tidur"
+)
+
 def detect_language(text: str) -> str:
-    malay_keywords = [
-        "mimpi","ruqyah","jin","sihir","doa","solat","sakit","gangguan","syaitan","hati","tidur"
-    ]
-    return "ms" if any(w in text.lower() for w in malay_keywords) else "en"
+    return "ms" if _MS_RE.search(text.lower()) else "en"
 
 def log_to_json(user_message: str, ai_reply: str, lang: str):
     entry = {
@@ -56,39 +153,156 @@ def log_to_json(user_message: str, ai_reply: str, lang: str):
         "user_message": user_message,
         "ai_reply": ai_reply,
     }
+    # Rotate once the file passes the byte threshold; one .1 backup kept
     try:
-        logs = json.load(open(LOG_FILE, "r", encoding="utf-8")) if os.path.exists(LOG_FILE) else []
-    except json.JSONDecodeError:
-        logs = []
-    logs.append(entry)
-    if len(logs) > 1000:
-        logs = logs[-500:]
-    json.dump(logs, open(LOG_FILE, "w", encoding="utf-8"), ensure_ascii=False, indent=2)
+        if os.path.getsize(LOG_FILE) >= LOG_MAX_BYTES:
+            os.rename(LOG_FILE, LOG_FILE + ".1")
+    except OSError:
+        pass
+    with open(LOG_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+# ==============================
+# RETRIEVAL
+# ==============================
+@lru_cache(maxsize=1024)
+def _embed(text: str) -> np.ndarray:
+    # Memoized on the normalized query; repeat questions skip the MiniLM forward
+    with torch.inference_mode():
+        return EMBEDDER.encode([text], convert_to_numpy=True).astype("float32")[0]
+
+def _embed_unit(text: str) -> np.ndarray:
+    vec = _embed(text)
+    return vec / (np.linalg.norm(vec) or 1.0)
+
+def retrieve_context_batch(queries: list, top_k: int = TOP_K) -> list:
+    # One stacked search amortizes the FAISS scan across concurrent queries
+    if FAISS_INDEX is None or not MAPPING:
+        return [""] * len(queries)
+    query_vecs = np.stack([_embed_unit(_normalize(q)) for q in queries])
+    _, I = FAISS_INDEX.search(query_vecs, top_k)
+    # Fancy-indexed gather; FAISS pads missing hits with -1, mask those out
+    return [
+        "\n".join(MAPPING_CONTENTS[row[(row >= 0) & (row < len(MAPPING_CONTENTS))]])
+        for row in I
+    ]
+
+def retrieve_context(query: str, top_k: int = TOP_K) -> str:
+    return retrieve_context_batch([query], top_k)[0]
+
+# ==============================
+# SEMANTIC CACHE
+# ==============================
+CACHE_MAX = 500
+CACHE_SIM_THRESHOLD = 0.92
+CACHE_TTL = float(os.getenv("CACHE_TTL", "3600"))  # seconds
+
+_kb_version = "0"    # hash of the loaded mapping; retrieval is deterministic given query + KB
+_cache_exact = {}    # sha256(kb_version | normalized prompt) -> (reply, expires_at)
+_cache_entries = []  # [(embedding, reply, expires_at), ...] oldest first
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+def _cache_key(norm: str) -> str:
+    return hashlib.sha256(f"{_kb_version}|{norm}".encode()).hexdigest()
+
+def cache_lookup(prompt: str) -> str | None:
+    norm = _normalize(prompt)
+    now = time.monotonic()
+    hit = _cache_exact.get(_cache_key(norm))
+    if hit is not None and hit[1] > now:
+        return hit[0]
+    live = [(vec, reply) for vec, reply, expires in _cache_entries if expires > now]
+    if not live:
+        return None
+    query_vec = _embed_unit(norm)
+    sims = np.stack([vec for vec, _ in live]) @ query_vec
+    best = int(np.argmax(sims))
+    if sims[best] >= CACHE_SIM_THRESHOLD:
+        return live[best][1]
+    return None
+
+def cache_store(prompt: str, reply: str):
+    norm = _normalize(prompt)
+    expires = time.monotonic() + CACHE_TTL
+    _cache_exact[_cache_key(norm)] = (reply, expires)
+    _cache_entries.append((_embed_unit(norm), reply, expires))
+    if len(_cache_entries) > CACHE_MAX:
+        del _cache_entries[: len(_cache_entries) - CACHE_MAX]
+    if len(_cache_exact) > 2 * CACHE_MAX:
+        _cache_exact.clear()
+
+# ==============================
+# MICRO-BATCHER
+# ==============================
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "8"))
+BATCH_WINDOW = float(os.getenv("BATCH_WINDOW", "0.05"))  # seconds to wait for more prompts
+
+_batch_queue: asyncio.Queue = None
+
+async def _batch_worker():
+    while True:
+        batch = [await _batch_queue.get()]
+        deadline = asyncio.get_event_loop().time() + BATCH_WINDOW
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - asyncio.get_event_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_batch_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # A raise here must not kill the worker: resolve the batch with the
+        # error reply and keep draining, or every later /chat hangs.
+        try:
+            contexts = await run_in_threadpool(
+                retrieve_context_batch, [prompt for prompt, _, _ in batch]
+            )
+            replies = await asyncio.gather(
+                *(ask_model(prompt, lang, context)
+                  for (prompt, lang, _), context in zip(batch, contexts))
+            )
+        except Exception as e:
+            replies = [f"⚠️ Ralat pelayan Hugging Face: {e}"] * len(batch)
+        for (_, _, future), reply in zip(batch, replies):
+            if not future.done():
+                future.set_result(reply)
+
+async def ask_model_batched(prompt: str, lang: str) -> str:
+    future = asyncio.get_event_loop().create_future()
+    await _batch_queue.put((prompt, lang, future))
+    return await future
 
 # ==============================
 # MAIN CHAT FUNCTION
 # ==============================
-def ask_model(prompt: str, lang: str) -> str:
-    try:
-        system_prompt = (
-            "Anda ialah pembantu Islam yang memahami Bahasa Melayu. "
-            "Bantu pengguna memahami mimpi, gangguan spiritual, ruqyah, dan penyembuhan Islam "
-            "berdasarkan Al-Quran dan Sunnah."
+def build_messages(prompt: str, lang: str, context: str = "") -> list:
+    system_prompt = _SYS_MS if lang == "ms" else _SYS_EN
+    if context:
+        prompt = (
+            f"Konteks:\n{context}\n\nSoalan: {prompt}"
             if lang == "ms" else
-            "You are an Islamic assistant that interprets dreams and spiritual sickness "
-            "based on Qur'an and Sunnah. Reply politely and concisely."
+            f"Context:\n{context}\n\nQuestion: {prompt}"
         )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
 
-        completion = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=200,
-            temperature=0.7,
-        )
-        return completion.choices[0].message["content"].strip()
+async def ask_model(prompt: str, lang: str, context: str = "") -> str:
+    try:
+        async with HF_SEM:
+            response = await app.state.http.post(
+                HF_URL,
+                json={
+                    "model": MODEL_NAME,
+                    "messages": build_messages(prompt, lang, context),
+                    **_PARAMS,
+                },
+            )
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"].strip()
     except Exception as e:
         return f"⚠️ Ralat pelayan Hugging Face: {e}"
 
@@ -100,19 +314,75 @@ def home():
     return {"message": "🕌 Islamic Spiritual Sickness Chatbot Backend (HF 2025) is running."}
 
 @app.post("/chat")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, bg: BackgroundTasks):
     user_message = request.message.strip()
     if not user_message:
         return {"reply": "Sila masukkan soalan anda."}
 
     lang = detect_language(user_message)
-    ai_reply = ask_model(user_message, lang)
-    log_to_json(user_message, ai_reply, lang)
+    # MiniLM encode + FAISS search are CPU-bound; keep them off the event loop
+    ai_reply = await run_in_threadpool(cache_lookup, user_message)
+    if ai_reply is None:
+        if _batch_queue.qsize() >= MAX_PENDING:
+            raise HTTPException(status_code=429, detail="Pelayan sibuk, sila cuba sebentar lagi.")
+        ai_reply = await ask_model_batched(user_message, lang)
+        if not ai_reply.startswith("⚠️"):
+            # cache_store embeds the prompt too — keep it off the event loop
+            bg.add_task(cache_store, user_message, ai_reply)
+    bg.add_task(log_to_json, user_message, ai_reply, lang)
 
     return {"reply": ai_reply or "Maaf, saya tidak dapat memahami pertanyaan anda."}
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    user_message = request.message.strip()
+    if not user_message:
+        return {"reply": "Sila masukkan soalan anda."}
+
+    lang = detect_language(user_message)
+    context = await run_in_threadpool(retrieve_context, user_message)
+    payload = {
+        "model": MODEL_NAME,
+        "messages": build_messages(user_message, lang, context),
+        **_PARAMS,
+        "stream": True,
+    }
+
+    async def token_stream():
+        parts = []
+        try:
+            async with HF_SEM, app.state.http.stream(
+                "POST", HF_URL, json=payload
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    delta = json.loads(data)["choices"][0]["delta"].get("content") or ""
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+        except Exception as e:
+            # Partial output: never cache or log it (mirrors /chat's ⚠️ guard)
+            yield f"⚠️ Ralat pelayan Hugging Face: {e}"
+            return
+        reply = "".join(parts).strip()
+        if reply:
+            # Embed + file write are blocking; the generator runs on the loop
+            await run_in_threadpool(cache_store, user_message, reply)
+            await run_in_threadpool(log_to_json, user_message, reply, lang)
+
+    return StreamingResponse(token_stream(), media_type="text/plain")
+
 @app.get("/logs")
-def get_logs():
-    if not os.path.exists(LOG_FILE):
+def get_logs(limit: int = LOGS_LIMIT):
+    try:
+        with open(LOG_FILE, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    except FileNotFoundError:
         return {"logs": []}
-    return {"logs": json.load(open(LOG_FILE, "r", encoding="utf-8"))}
+    limit = max(1, min(limit, LOGS_LIMIT))
+    return {"logs": [json.loads(line) for line in lines[-limit:] if line.strip()]}
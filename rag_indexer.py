@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import json, os
 import numpy as np
+import torch
 import faiss
 from sentence_transformers import SentenceTransformer
 
@@ -9,21 +10,60 @@ KB_PATH = os.path.join(BASE, "data", "knowledge_base.json")
 INDEX_PATH = os.path.join(BASE, "data", "knowledge_index.faiss")
 MAPPING_PATH = os.path.join(BASE, "data", "knowledge_mapping.json")
 
+def _encode(embedder, texts):
+    with torch.inference_mode():
+        embeddings = embedder.encode(
+            texts, batch_size=64, convert_to_numpy=True, show_progress_bar=False
+        ).astype('float32')
+    faiss.normalize_L2(embeddings)
+    return embeddings
+
 def build():
-    embedder = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+    torch.set_num_threads(os.cpu_count() or 1)
+    embedder = SentenceTransformer(
+        "sentence-transformers/all-MiniLM-L6-v2",
+        backend=os.getenv("EMBED_BACKEND", "torch"),
+    )
     with open(KB_PATH, 'r', encoding='utf-8') as f:
         docs = json.load(f)
     texts = [d['content'] for d in docs]
     if len(texts) == 0:
         print("No docs to index.")
         return
-    embeddings = embedder.encode(texts, convert_to_numpy=True).astype('float32')
-    index = faiss.IndexFlatL2(embeddings.shape[1])
-    index.add(embeddings)
+
+    # Reuse the existing index when the KB only grew: encode and add just
+    # the new docs instead of re-embedding everything.
+    index, start = None, 0
+    if os.path.exists(INDEX_PATH) and os.path.exists(MAPPING_PATH):
+        with open(MAPPING_PATH, 'r', encoding='utf-8') as f:
+            old_texts = [d['content'] for d in json.load(f)]
+        if old_texts == texts[:len(old_texts)]:
+            index = faiss.read_index(INDEX_PATH)
+            start = len(old_texts)
+
+    new_texts = texts[start:]
+    if index is not None and not new_texts:
+        print(f"Index up to date ({len(texts)} documents).")
+        return
+    if index is None:
+        embeddings = _encode(embedder, texts)
+        # Cosine via inner product on unit vectors; 8-bit scalar quantization
+        # cuts bytes/vector 4x vs fp32, so scans move a quarter of the memory
+        index = faiss.IndexScalarQuantizer(
+            embeddings.shape[1], faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(embeddings)
+        index.add(embeddings)
+    elif new_texts:
+        index.add(_encode(embedder, new_texts))
+
     faiss.write_index(index, INDEX_PATH)
     with open(MAPPING_PATH, 'w', encoding='utf-8') as f:
         json.dump(docs, f, ensure_ascii=False, indent=2)
-    print(f"Indexed {len(texts)} documents.")
+    if start:
+        print(f"Added {len(new_texts)} new documents ({len(texts)} total).")
+    else:
+        print(f"Indexed {len(texts)} documents.")
 
 if __name__ == '__main__':
     build()